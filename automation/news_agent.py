@@ -1,44 +1,84 @@
-import os, json, re, inspect
+import os, json, re, inspect, hashlib, time, logging
 from datetime import datetime, timedelta
+from functools import lru_cache
+from collections import defaultdict, deque
 from urllib.parse import urlparse
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 from dotenv import load_dotenv
 import requests
-from github import Github, Auth
+from github import Auth, Github, GithubException, UnknownObjectException
 
 from xai_sdk import Client
 from xai_sdk.chat import user
 from xai_sdk.tools import web_search, x_search
 
-# ───────────────────────── Env ─────────────────────────
-root_env = os.path.join(os.path.dirname(__file__), "..", ".env")
-load_dotenv(dotenv_path=root_env) if os.path.exists(root_env) else load_dotenv()
-
-XAI_API_KEY  = (os.getenv("XAI_API_KEY") or "").strip()
-GITHUB_TOKEN = (os.getenv("GITHUB_TOKEN") or "").strip()
-GITHUB_REPO  = (os.getenv("GITHUB_REPO") or "spazedd/github.io").strip()
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-if not XAI_API_KEY: raise SystemExit("Missing XAI_API_KEY")
-if not GITHUB_TOKEN: raise SystemExit("Missing GITHUB_TOKEN")
-if "/" not in GITHUB_REPO: raise SystemExit(f"GITHUB_REPO must be 'owner/repo'. Got: {GITHUB_REPO!r}")
+try:
+    import re2
+except ImportError:
+    re2 = None
 
-# ───────────────────────── Dates/Paths ─────────────────────────
-today = datetime.now().strftime("%Y-%m-%d")
-tomorrow = (datetime.now() + timedelta(days=1)).strftime("%Y-%m-%d")
-file_name = f"news-{today}.json"
-repo_data_path = f"data/{file_name}"
-commit_message = f"Daily News {today}"
+log = logging.getLogger("news_agent")
 
+# ───────────────────────── Paths ─────────────────────────
 REPO_ROOT = Path(__file__).resolve().parent.parent
-(REPO_ROOT / "data").mkdir(parents=True, exist_ok=True)
-local_path = REPO_ROOT / "data" / file_name
+DATA_DIR = REPO_ROOT / "data"
 
 # ───────────────────────── Model ─────────────────────────
 MODEL = "grok-4"
+# Tools sent with the chat; their names also key the response cache
+TOOLS = (web_search, x_search)
+MAX_RESPONSE_CHARS = 256_000  # a 15-story answer is a few KB; anything this big is runaway output
+
+# Raw model answers are cached on disk so reruns of the same prompt skip the API call
+CACHE_DIR = REPO_ROOT / ".cache" / "news"
+CACHE_TTL = 6 * 3600  # seconds
+
+# ───────────────────────── Publishing ─────────────────────────
+TARGET = 12  # publish at most 12
+PER_DOMAIN_CAP = 4
+MIN_PUBLISH = 10
+
+# ───────────────────────── Text ─────────────────────────
+BAD_PREFIXES = ("analysis", "report", "update")
+# re2 (if installed) turns the literal alternation into a single DFA; re is the fallback
+_BAD_PREFIX_RE = (re2 or re).compile(rf"^\s*(?:{'|'.join(BAD_PREFIXES)})[:\-–]\s*")
+_FENCE_RE = re.compile(r"^```(?:json)?\s*\n|\n```\s*$", re.I)
+
+def clean_title(s) -> str:
+    s = str(s or "")
+    if s.lstrip().startswith(BAD_PREFIXES): s = _BAD_PREFIX_RE.sub("", s)
+    return s.strip()
+
+def clean_details(s) -> str:
+    s = str(s or "")
+    # Printable with no double spaces means the only whitespace is single " "s: nothing to collapse
+    if s.isprintable() and "  " not in s: return s.strip()
+    return " ".join(s.split())
+
+def first_sentences(s: str, n: int = 4) -> str:
+    # Same result as splitting on (?<=[.!?])\s+ and joining the first n parts,
+    # but stops scanning at the nth sentence boundary.
+    parts, start, i, size = [], 0, 0, len(s)
+    while i < size - 1:
+        if s[i] in ".!?" and s[i + 1].isspace():
+            parts.append(s[start:i + 1])
+            if len(parts) == n: return " ".join(parts)
+            i += 1
+            while i < size and s[i].isspace(): i += 1
+            start = i
+        else:
+            i += 1
+    return s
 
 # ───────────────────────── Domains ─────────────────────────
-ALLOWED_DOMAINS = {
+ALLOWED_DOMAINS = frozenset({
     "reuters.com","wsj.com","bbc.com","bbc.co.uk","thehill.com","nypost.com",
     "nationalreview.com","apnews.com","bloomberg.com","ft.com","politico.com",
     "washingtonexaminer.com","foxnews.com","newsmax.com","cbsnews.com","abcnews.go.com",
@@ -46,152 +86,275 @@ ALLOWED_DOMAINS = {
     "businessinsider.com","techcrunch.com","arstechnica.com","wired.com",
     "venturebeat.com","statnews.com","nature.com","defensenews.com","city-journal.org",
     "thefp.com","thefederalist.com","justthenews.com","quillette.com"
-}
+})
 
+@lru_cache(maxsize=256)
 def host_ok(host: str) -> bool:
-    return bool(host) and any(host == d or host.endswith("." + d) for d in ALLOWED_DOMAINS)
+    # Drop leading labels until an allowed domain matches: "www.bbc.co.uk" -> "bbc.co.uk"
+    while host:
+        if host in ALLOWED_DOMAINS: return True
+        i = host.find(".")
+        if i < 0: return False
+        host = host[i + 1:]
+    return False
 
+# Second-level suffixes under which the registrable domain has three labels
+_TWO_LABEL_SUFFIXES = frozenset(f"{sld}.{cc}" for sld in ("co", "com", "org", "net") for cc in ("uk", "au"))
+
+@lru_cache(maxsize=256)
 def base_domain(host: str) -> str:
-    parts = host.lower().split(".")
-    if len(parts) >= 3 and parts[-2] in {"co", "com", "org", "net"} and parts[-1] in {"uk","au"}:
-        return ".".join(parts[-3:])
-    return ".".join(parts[-2:]) if len(parts) >= 2 else host.lower()
-
-def rebalance_by_domain(valid, raw_pool, target=15, per_cap=4):
-    picked, counts, used = [], {}, set()
-    for it in valid:
-        try: d = base_domain(urlparse(it["source"]).netloc)
-        except: continue
-        if counts.get(d, 0) >= per_cap: continue
-        picked.append(it)
-        counts[d] = counts.get(d, 0) + 1
-        used.add(it["source"])
-    if len(picked) < target:
-        for it in raw_pool:
-            if not isinstance(it, dict): continue
-            s = (it.get("source") or it.get("url") or "").strip()
-            t = (it.get("title") or "").strip()
-            dsc = (it.get("details") or "").strip()
-            if not (t and dsc and s) or s in used: continue
-            try: host = urlparse(s).netloc
-            except: continue
-            if not host or not host_ok(host): continue
-            bd = base_domain(host)
-            if counts.get(bd, 0) >= per_cap: continue
-            parts = re.split(r"(?<=[.!?])\s+", dsc)
-            if len(parts) > 4: dsc = " ".join(parts[:4])
-            picked.append({"title": t, "details": dsc, "source": s})
-            counts[bd] = counts.get(bd, 0) + 1
-            used.add(s)
-            if len(picked) >= target: break
-    return picked[:target]
+    host = host.lower()
+    i = host.rfind(".")
+    if i < 0: return host
+    j = host.rfind(".", 0, i)
+    if j < 0: return host
+    if host[j + 1:] in _TWO_LABEL_SUFFIXES:
+        k = host.rfind(".", 0, j)
+        return host[k + 1:]
+    return host[j + 1:]
+
+def first_of(d: dict, keys, default=""):
+    """First truthy value among keys, so alias lookups share one loop."""
+    for k in keys:
+        v = d.get(k)
+        if v: return v
+    return default
+
+def normalize(item):
+    """Clean one raw story from the model; None if title, details or source is missing."""
+    if not isinstance(item, dict): return None
+    title = clean_title(item.get("title"))
+    details = clean_details(first_of(item, ("details", "summary")))
+    source = first_of(item, ("source", "url")).strip()
+    if not (title and details and source): return None
+    try: p = urlparse(source)
+    except ValueError: host, key = "", source
+    else: host, key = p.hostname or "", f"{p.netloc.lower()}{p.path.rstrip('/')}"
+    # "_"-prefixed keys are working state and are dropped before saving;
+    # "_key" ignores scheme, query and fragment so utm_* variants dedupe
+    return {"title": title, "details": first_sentences(details), "source": source,
+            "_host": host, "_bd": base_domain(host), "_key": key}
+
+# http(s), optional userinfo, an allowed host or subdomain, optional port, then a non-empty path
+_URL_OK_RE = (re2 or re).compile(
+    r"(?i)^https?://(?:[^/?#]*@)?(?:[^/?#@:]*\.)?(?:"
+    + "|".join(re.escape(d) for d in sorted(ALLOWED_DOMAINS))
+    + r")(?::[^/?#@]*)?/+[^/?#]"
+)
+
+def url_ok(it) -> bool:
+    return _URL_OK_RE.match(it["source"]) is not None
+
+def rebalance_by_domain(valid, pool, target=TARGET, per_cap=PER_DOMAIN_CAP):
+    # Each tier (valid first, then allowlisted backfill) is bucketed by outlet in one pass and
+    # drained round-robin, so early stories from one outlet can't crowd out the rest.
+    picked, counts, used, rank = [], defaultdict(int), set(), 0
+    for tier in (valid, (it for it in pool if host_ok(it["_host"]))):
+        buckets = defaultdict(deque)
+        for it in tier:
+            if it["_key"] in used: continue
+            used.add(it["_key"])
+            buckets[it["_bd"]].append((rank, it))
+            rank += 1
+        while len(picked) < target and buckets:
+            for bd, q in list(buckets.items()):
+                if counts[bd] >= per_cap or not q:
+                    del buckets[bd]
+                    continue
+                picked.append(q.popleft())
+                counts[bd] += 1
+                if len(picked) >= target: break
+        if len(picked) >= target: break
+    return [it for _, it in sorted(picked, key=lambda p: p[0])]
+
+def json_loads(text):
+    return orjson.loads(text) if orjson else json.loads(text)
+
+_DECODER = json.JSONDecoder()
+
+def parse_first_array(text):
+    # Decode from the first "[" and stop where that array closes: one pass of the C
+    # scanner, no rfind("]") and no sliced copy; trailing prose is ignored.
+    start = text.find("[")
+    return json_loads(text) if start == -1 else _DECODER.raw_decode(text, start)[0]
+
+def json_dumps(obj) -> bytes:
+    if orjson: return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+
+def write_atomic(path: Path, data: bytes):
+    # Write a sibling temp file and rename over the target so readers never see a partial file
+    tmp = path.with_suffix(".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+# ───────────────────────── GitHub ─────────────────────────
+def open_repo(token: str, repo_name: str):
+    # PyGithub keeps one pooled keep-alive session per client; lazy=True skips the
+    # GET /repos round-trip since only the repo's path is needed to read/write contents.
+    gh = Github(auth=Auth.Token(token), lazy=True)
+    return gh.get_repo(repo_name)
+
+def find_existing(repo, path):
+    try: return repo.get_contents(path, ref="main")
+    except UnknownObjectException: return None
+
+def push_file(repo, path, message, content, existing):
+    """Create, update or skip path; returns what was done."""
+    if existing is None:
+        repo.create_file(path, message, content, branch="main")
+        return "Created"
+    if existing.decoded_content == content: return None
+    repo.update_file(existing.path, message, content, existing.sha, branch="main")
+    return "Updated"
 
 # ───────────────────────── Prompt ─────────────────────────
-prompt = f"""
-Generate a flat JSON array (valid JSON, no markdown) of 12–15 stories from TODAY ONLY ({today}).
-Each story: {{
+# Everything date-independent comes first so the provider can reuse the cached prefix
+# across days; only the short TODAY/TOMORROW suffix changes between runs.
+PROMPT_PREFIX = """
+Generate a flat JSON array (valid JSON, no markdown) of 12–15 stories from TODAY ONLY (the TODAY date below).
+Each story: {
   "title": "Concise, human title (<= 15 words)",
   "details": "3–4 full sentences: Fact, context, effect, and a short logical analysis highlighting inefficiencies, hypocrisies, or unintended consequences (subtly implying national sovereignty, efficiency, self-reliance). 400–600 characters.",
   "source": "https://real-article-url-from-today"
-}}
+}
 Rules:
-- Use tools: search since:{today} until:{tomorrow}, browse to verify date.
+- Use tools: search since:<TODAY> until:<TOMORROW> using the dates at the end, browse to verify date.
 - Real news only. Blend politics/econ/tech/world + controversial items.
 - At least 6 distinct outlets; ≤4 per outlet to ensure diversity.
 """
 
+def build_prompt(today: str, tomorrow: str) -> str:
+    return f"{PROMPT_PREFIX}\nTODAY={today}\nTOMORROW={tomorrow}\n"
+
 # ───────────────────────── xAI Call ─────────────────────────
-client = Client(api_key=XAI_API_KEY)
-chat = client.chat.create(model=MODEL, tools=[web_search(), x_search()], messages=[])
-chat.append(user(prompt))
+@lru_cache(maxsize=8)
+def sample_kwargs(fn):
+    """(accepts temperature, accepts max_tokens, accepts **kwargs) for a sample() callable."""
+    params = inspect.signature(fn).parameters.values()
+    names = {p.name for p in params}
+    return "temperature" in names, "max_tokens" in names, any(p.kind == p.VAR_KEYWORD for p in params)
 
 def sample_chat(chat_obj, temperature=0.2, max_tokens=2500):
-    sig = inspect.signature(chat_obj.sample)
-    params = list(sig.parameters.values())
-    names = {p.name for p in params}
-    if any(p.kind == p.VAR_KEYWORD for p in params):
+    # Keyed on the class's function, so each SDK Chat class is introspected once
+    takes_temp, takes_max, takes_varkw = sample_kwargs(type(chat_obj).sample)
+    if takes_varkw:
         return chat_obj.sample(temperature=temperature, max_tokens=max_tokens)
     kw = {}
-    if "temperature" in names: kw["temperature"] = temperature
-    if "max_tokens" in names: kw["max_tokens"] = max_tokens
+    if takes_temp: kw["temperature"] = temperature
+    if takes_max: kw["max_tokens"] = max_tokens
     return chat_obj.sample(**kw) if kw else chat_obj.sample()
 
-resp = sample_chat(chat)
-raw = (getattr(resp, "content", None) or "").strip()
-
-# Extract JSON
-if raw.startswith("```"): raw = raw.strip("`")[raw.find("\n")+1:]
-start, end = raw.find("["), raw.rfind("]")
-json_text = raw[start:end+1] if start != -1 and end != -1 else raw
+def load_cached(key):
+    path = CACHE_DIR / f"{key}.txt"
+    try:
+        if time.time() - path.stat().st_mtime < CACHE_TTL:
+            log.info("Using cached response %s", path.name)
+            return path.read_text(encoding="utf-8")
+    except OSError: pass
+    return None
 
-# Parse
-try: data = json.loads(json_text)
-except json.JSONDecodeError as e: raise SystemExit(f"JSON error: {e}\nRaw: {raw[:400]}")
+def store_cached(key, content):
+    # Only called once the answer has parsed and yielded stories, so a bad answer is never replayed
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    write_atomic(CACHE_DIR / f"{key}.txt", content.encode("utf-8"))
 
-if not isinstance(data, list):
+# ───────────────────────── Agent ─────────────────────────
+def parse_stories(raw: str) -> list:
+    # Checked before any strip/regex pass copies or scans the buffer
+    if len(raw) > MAX_RESPONSE_CHARS:
+        raise SystemExit(f"Model output too large: {len(raw):,} chars (limit {MAX_RESPONSE_CHARS:,})")
+    raw = _FENCE_RE.sub("", raw.strip()).strip()
+    try: data = parse_first_array(raw)
+    except json.JSONDecodeError as e: raise SystemExit(f"JSON error: {e}\nRaw: {raw[:400]}")
+    if isinstance(data, list): return data
     flat = []
     if isinstance(data, dict):
         for v in data.values():
             if isinstance(v, list): flat.extend(v)
-    data = flat
-
-# Clean & validate
-validated = []
-for item in data:
-    if not isinstance(item, dict): continue
-    title = re.sub(r"^\s*(analysis|report|update)[:\-–]\s*", "", str(item.get("title", ""))).strip()
-    details = re.sub(r"\s+", " ", str(item.get("details") or "")).strip()
-    source = (item.get("source") or "").strip()
-    if not (title and details and source): continue
-    parts = re.split(r"(?<=[.!?])\s+", details)
-    if len(parts) > 4: details = " ".join(parts[:4])
+    return flat
+
+def select_stories(data, target_count=TARGET, per_domain_cap=PER_DOMAIN_CAP, min_publish=MIN_PUBLISH):
+    # Clean & validate
+    normalized = [n for n in map(normalize, data) if n]
+    out = [n for n in normalized if url_ok(n)]
+
+    # Fallback if low count
+    if len(out) < min_publish:
+        log.warning("⚠️ Low count (%d); backfilling...", len(out))
+        seen = {it["_key"] for it in out}
+        for it in normalized:
+            if it["_key"] not in seen:
+                out.append(it)
+                seen.add(it["_key"])
+
+    return rebalance_by_domain(out, normalized, target=target_count, per_cap=per_domain_cap)
+
+def run_agent(xai_api_key, github_token, github_repo,
+              target_count=TARGET, per_domain_cap=PER_DOMAIN_CAP, min_publish=MIN_PUBLISH):
+    now = datetime.now()  # read the clock once so today/tomorrow agree across midnight
+    today = now.strftime("%Y-%m-%d")
+    tomorrow = (now + timedelta(days=1)).strftime("%Y-%m-%d")
+    repo_data_path = f"data/news-{today}.json"
+    commit_message = f"Daily News {today}"
+    prompt = build_prompt(today, tomorrow)
+
+    client = Client(api_key=xai_api_key)
+    chat = client.chat.create(model=MODEL, tools=[t() for t in TOOLS], messages=[])
+    chat.append(user(prompt))
+
+    cache_key = hashlib.sha256("\0".join((MODEL, ",".join(t.__name__ for t in TOOLS), prompt)).encode()).hexdigest()
+    # Looking up today's file doesn't depend on the model, so it runs while the model generates
+    repo = open_repo(github_token, github_repo)
+    with ThreadPoolExecutor(max_workers=1) as ex:
+        existing_lookup = ex.submit(find_existing, repo, repo_data_path)
+        raw = load_cached(cache_key)
+        cached = raw is not None
+        if not cached: raw = getattr(sample_chat(chat), "content", None) or ""
+
+    data = parse_stories(raw)
+    out = select_stories(data, target_count, per_domain_cap, min_publish)
+    if not out: raise SystemExit("No usable stories")
+    if not cached: store_cached(cache_key, raw)
+
+    # Save & push
+    stories = [{k: v for k, v in it.items() if not k.startswith("_")} for it in out]
+    content = json_dumps(stories)
+    DATA_DIR.mkdir(parents=True, exist_ok=True)
+    write_atomic(DATA_DIR / f"news-{today}.json", content)
+
     try:
-        p = urlparse(source)
-        if p.scheme not in {"http","https"} or not p.netloc or not p.path.strip("/"): continue
-        if not host_ok(p.hostname.lower()): continue
-    except: continue
-    validated.append({"title": title, "details": details, "source": source})
+        action = push_file(repo, repo_data_path, commit_message, content, existing_lookup.result())
+    except GithubException as e:
+        # The sha was read before the model call; if the file moved since (409, or 422 when it
+        # was created meanwhile), look it up again and retry once
+        if e.status not in {409, 422}: raise
+        log.warning("%s changed during the run (%d); retrying", repo_data_path, e.status)
+        action = push_file(repo, repo_data_path, commit_message, content, find_existing(repo, repo_data_path))
+    if action: log.info("%s %s with %d stories", action, repo_data_path, len(out))
+    else: log.info("%s unchanged; nothing to push", repo_data_path)
 
-# Fallback if low count
-MIN_PUBLISH = 10
-out = validated
-if len(out) < MIN_PUBLISH:
-    print("⚠️ Low count; backfilling...")
-    fallback = []
-    for item in data:
-        if not isinstance(item, dict): continue
-        t = re.sub(r"^\s*(analysis|report|update)[:\-–]\s*", "", str(item.get("title", ""))).strip()
-        d = re.sub(r"\s+", " ", str(item.get("details") or "")).strip()
-        s = (item.get("source") or "").strip()
-        if not (t and d and s): continue
-        parts = re.split(r"(?<=[.!?])\s+", d)
-        if len(parts) > 4: d = " ".join(parts[:4])
-        fallback.append({"title": t, "details": d, "source": s})
-    seen = {it["source"] for it in out}
-    for it in fallback:
-        if it["source"] not in seen:
-            out.append(it)
-            seen.add(it["source"])
-
-# Rebalance
-TARGET = 15
-PER_DOMAIN_CAP = 4
-out = rebalance_by_domain(out, data, target=TARGET, per_cap=PER_DOMAIN_CAP)
-if not out: raise SystemExit("No usable stories")
-out = out[:12]  # Cap at 12 max
+def log_level(value) -> int:
+    # LOG accepts a number ("10") or a level name ("debug"); anything else falls back to INFO
+    value = str(value or "").strip()
+    if value.isdigit(): return int(value)
+    level = logging.getLevelName(value.upper())
+    return level if isinstance(level, int) else logging.INFO
 
-# Save & push
-with open(local_path, "w", encoding="utf-8") as f:
-    json.dump(out, f, indent=2, ensure_ascii=False)
+def main():
+    root_env = os.path.join(os.path.dirname(__file__), "..", ".env")
+    load_dotenv(dotenv_path=root_env) if os.path.exists(root_env) else load_dotenv()
+    logging.basicConfig(level=log_level(os.environ.get("LOG")), format="%(asctime)s %(levelname)s %(message)s")
 
-gh = Github(auth=Auth.Token(GITHUB_TOKEN))
-repo = gh.get_repo(GITHUB_REPO)
-with open(local_path, "r", encoding="utf-8") as f: content = f.read()
+    xai_api_key  = (os.getenv("XAI_API_KEY") or "").strip()
+    github_token = (os.getenv("GITHUB_TOKEN") or "").strip()
+    github_repo  = (os.getenv("GITHUB_REPO") or "spazedd/github.io").strip()
 
-try:
-    repo.create_file(repo_data_path, commit_message, content, branch="main")
-    print(f"Created {repo_data_path} with {len(out)} stories")
-except Exception:
-    existing = repo.get_contents(repo_data_path, ref="main")
-    repo.update_file(existing.path, commit_message, content, existing.sha, branch="main")
-    print(f"Updated {repo_data_path} with {len(out)} stories")
\ No newline at end of file
+    if not xai_api_key: raise SystemExit("Missing XAI_API_KEY")
+    if not github_token: raise SystemExit("Missing GITHUB_TOKEN")
+    if "/" not in github_repo: raise SystemExit(f"GITHUB_REPO must be 'owner/repo'. Got: {github_repo!r}")
+
+    run_agent(xai_api_key, github_token, github_repo)
+
+if __name__ == "__main__":
+    main()